@@ -0,0 +1,18 @@
+import time
+
+# Shared by prepare_batch.py and submit_job.py; keep this free of third-party imports
+
+def backoff_intervals(initial=0.25, multiplier=1.5, cap=4.0):
+    # Short first wait for small files, growing so big ones don't hammer get_file
+    interval = initial
+    while True:
+        yield interval
+        interval = min(cap, interval * multiplier)
+
+def poll_with_backoff(file_ref, get_file, **backoff):
+    # Re-fetch the file until the File API has finished processing it
+    intervals = backoff_intervals(**backoff)
+    while file_ref.state.name == "PROCESSING":
+        time.sleep(next(intervals))
+        file_ref = get_file(file_ref.name)
+    return file_ref
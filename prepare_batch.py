@@ -1,77 +1,291 @@
 import os
-import glob
-import time
+import re
+import sys
+import itertools
 import json
-import google.generativeai as genai
+import orjson
+import asyncio
+import hashlib
+import aiohttp
 from pathlib import Path
+from datetime import datetime, timezone
+from backoff import backoff_intervals
 
 # --- CONFIGURATION ---
 API_KEY = os.environ.get("GEMINI_API_KEY")
 PDF_DIR = "pdfs"
 MODEL_NAME = "models/gemini-1.5-flash-002" # Flash is best for batch
 BATCH_ID_FILE = "current_batch_id.txt"
+JSONL_PATH = "batch_requests.jsonl"
+BASE_URL = "https://generativelanguage.googleapis.com"
+UPLOAD_CONCURRENCY = 32 # In-flight File API uploads
+MAX_POLL_FAILURES = 5 # Consecutive transient status-check errors before giving up on a file
+UPLOAD_CACHE_FILE = "upload_cache.json" # sha256 -> uploaded file, reused across runs
+
+# Memos are tagged "MEMO", "MEMORANDUM" or "MG" (marking guidelines) as their own
+# filename token, optionally followed by a digit or "(" (e.g. Memo2019, MEMO(1))
+MEMO_RE = re.compile(r"(?:^|[_\-\s])(MEMO(?:RANDUM)?|MG)(?:[_\-\s.(]|\d|$)", re.IGNORECASE)
+
+# --- UPLOAD CACHE ---
+# Identical PDFs (re-runs, memos shared across years) map to the same File API
+# upload for as long as Gemini keeps it around.
+_upload_cache = None
+_upload_cache_dirty = False
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def load_upload_cache():
+    global _upload_cache
+    if _upload_cache is None:
+        try:
+            with open(UPLOAD_CACHE_FILE) as f:
+                _upload_cache = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            _upload_cache = {}
+        if not isinstance(_upload_cache, dict):
+            _upload_cache = {}
+    return _upload_cache
+
+def save_upload_cache(cache):
+    # Write to a temp file and swap it in so a crash never leaves half a cache
+    tmp_path = UPLOAD_CACHE_FILE + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f, indent=2)
+    os.replace(tmp_path, UPLOAD_CACHE_FILE)
+
+def flush_upload_cache():
+    # Persist new uploads once per run rather than rewriting the file per upload
+    global _upload_cache_dirty
+    if not _upload_cache_dirty:
+        return
+    try:
+        save_upload_cache(_upload_cache)
+        _upload_cache_dirty = False
+    except Exception as e:
+        print(f"⚠️  Could not save {UPLOAD_CACHE_FILE}: {e}")
+
+async def get_file(session, name):
+    async with session.get(f"{BASE_URL}/v1beta/{name}") as resp:
+        resp.raise_for_status()
+        return await resp.json()
+
+async def cached_upload(session, digest):
+    # The cache is only an optimisation: any problem with it counts as a miss
+    try:
+        entry = load_upload_cache().get(digest)
+        if not entry:
+            return None
+
+        expires_at = datetime.fromisoformat(entry["expires_at"])
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        if expires_at <= datetime.now(timezone.utc):
+            return None
+
+        file = await get_file(session, entry["name"])
+        if file["state"] != "ACTIVE":
+            return None
+        return file
+    except Exception:
+        return None
+
+def remember_upload(digest, file):
+    # Never fail an upload that succeeded just because it couldn't be cached.
+    # Only updates memory; upload_all flushes the cache to disk when it finishes.
+    global _upload_cache_dirty
+    try:
+        cache = load_upload_cache()
+        cache[digest] = {
+            "uri": file["uri"],
+            "name": file["name"],
+            "expires_at": file["expirationTime"],
+        }
+        _upload_cache_dirty = True
+    except Exception as e:
+        print(f"⚠️  Could not cache upload {file.get('name')}: {e}")
+
+def iter_pdfs(directory):
+    # Lazily yield PDFs so uploads can start while the directory is still being scanned.
+    # A missing directory yields nothing, like glob.glob did.
+    try:
+        it = os.scandir(directory)
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    with it:
+        for entry in it:
+            if entry.is_file() and entry.name.lower().endswith(".pdf"):
+                yield entry.path
 
 def setup():
     if not API_KEY:
         print("❌ Error: GEMINI_API_KEY environment variable not set.")
         exit(1)
-    genai.configure(api_key=API_KEY)
 
-def upload_file(path):
-    print(f"DTO Uploading {path}...")
+async def start_upload(session, sem, inflight, path):
+    # Identical PDFs in one run share a single upload task keyed by content
+    # hash; the on-disk cache covers re-runs
     try:
-        # Upload the file to Gemini File API
-        # We use the File API because we are sending PDFs directly
-        # Note: In Batch API, we reference files by URI
-        file_ref = genai.upload_file(path=path, mime_type="application/pdf")
-        
-        # Wait for processing
-        while file_ref.state.name == "PROCESSING":
-            print(".", end="", flush=True)
-            time.sleep(2)
-            file_ref = genai.get_file(file_ref.name)
-            
-        if file_ref.state.name != "ACTIVE":
-            print(f"❌ File {path} failed to process: {file_ref.state.name}")
-            return None
-            
-        print(f"✅ Ready: {file_ref.uri}")
-        return file_ref.uri
-    except Exception as e:
+        digest = await asyncio.to_thread(file_sha256, path)
+    except OSError as e:
         print(f"❌ Upload failed: {e}")
         return None
+    if digest in inflight:
+        print(f"♻️  Duplicate: {path} shares an upload with an identical PDF")
+    else:
+        inflight[digest] = asyncio.create_task(upload_digest(session, sem, digest, path))
+    return await inflight[digest]
 
-def create_batch_request(pdf_files):
-    requests = []
-    
-    # QP Schema (Simplified for compactness in script, but strictly enforcing structure)
-    qp_schema = {
-      "type": "OBJECT",
-      "properties": {
-        "subject": {"type": "STRING"},
-        "year": {"type": "INTEGER"},
-        "session": {"type": "STRING"},
-        "total_marks": {"type": "INTEGER"},
-        "groups": {
-          "type": "ARRAY",
-          "items": {
-            "type": "OBJECT",
-            "properties": {
-              "group_id": {"type": "STRING"},
-              "title": {"type": "STRING"},
-              "questions": {
-                "type": "ARRAY",
-                "items": {
-                  "type": "OBJECT",
-                  "properties": {
-                    "id": {"type": "STRING"},
-                    "text": {"type": "STRING"},
-                    "marks": {"type": "INTEGER"},
-                    "options": {
-                      "type": "ARRAY", 
-                      "items": {"type": "OBJECT", "properties": {"label": {"type": "STRING"}, "text": {"type": "STRING"}}}
-                    }
-                  }
+async def upload_digest(session, sem, digest, path):
+    # Kick off the upload without waiting for the File API to process it.
+    # Talks to the REST endpoints directly since the SDK only uploads synchronously.
+    async with sem:
+        try:
+            file = await cached_upload(session, digest)
+            if file:
+                print(f"♻️  Cached: {path} -> {file['uri']}")
+                return file
+
+            print(f"DTO Uploading {path}...")
+            # Resumable upload: the start call returns a session URL, then the
+            # bytes go up in a single upload+finalize request
+            # Docs: https://ai.google.dev/api/files#method:-media.upload
+            size = os.path.getsize(path)
+            async with session.post(
+                f"{BASE_URL}/upload/v1beta/files",
+                headers={
+                    "X-Goog-Upload-Protocol": "resumable",
+                    "X-Goog-Upload-Command": "start",
+                    "X-Goog-Upload-Header-Content-Length": str(size),
+                    "X-Goog-Upload-Header-Content-Type": "application/pdf",
+                },
+                json={"file": {"display_name": os.path.basename(path)}},
+            ) as resp:
+                resp.raise_for_status()
+                upload_url = resp.headers["X-Goog-Upload-URL"]
+
+            with open(path, "rb") as f:
+                async with session.post(
+                    upload_url,
+                    headers={
+                        "Content-Length": str(size),
+                        "X-Goog-Upload-Offset": "0",
+                        "X-Goog-Upload-Command": "upload, finalize",
+                    },
+                    data=f,
+                ) as resp:
+                    resp.raise_for_status()
+                    file = (await resp.json())["file"]
+
+            # Cache lookups re-check the state, so a file that later fails to
+            # process is simply uploaded again next run
+            remember_upload(digest, file)
+            return file
+        except Exception as e:
+            print(f"❌ Upload failed: {e}")
+            return None
+
+def is_transient(error):
+    # Rate limits, server errors and dropped connections are worth retrying;
+    # anything else (bad key, deleted/expired file) will not clear by itself
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+async def wait_ready(session, files):
+    # Poll every pending file once per round (concurrently) instead of
+    # waiting on each file in turn. Returns {file name: uri} for ACTIVE files.
+    pending = {file["name"]: file for file in files}
+    failures = {}
+    ready = {}
+    intervals = backoff_intervals()
+    while True:
+        for name, file in list(pending.items()):
+            if file["state"] == "PROCESSING":
+                continue
+            del pending[name]
+            if file["state"] == "ACTIVE":
+                ready[name] = file["uri"]
+            else:
+                print(f"❌ File {file.get('displayName', name)} failed to process: {file['state']}")
+        if not pending:
+            return ready
+
+        await asyncio.sleep(next(intervals))
+        names = list(pending)
+        results = await asyncio.gather(*(get_file(session, name) for name in names), return_exceptions=True)
+        for name, result in zip(names, results):
+            if not isinstance(result, Exception):
+                pending[name] = result
+                failures.pop(name, None)
+                continue
+            failures[name] = failures.get(name, 0) + 1
+            if is_transient(result) and failures[name] < MAX_POLL_FAILURES:
+                print(f"⚠️  Status check failed for {name}, retrying: {result}")
+                continue
+            file = pending.pop(name)
+            print(f"❌ File {file.get('displayName', name)} failed status check: {result}")
+
+async def upload_all(pdf_files):
+    # Single-threaded fan-out: the semaphore caps in-flight uploads and the
+    # connector caps open connections for uploads and status polls alike
+    sem = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+    connector = aiohttp.TCPConnector(limit=UPLOAD_CONCURRENCY)
+    # The key goes in a header rather than ?key= so it never shows up in the
+    # request URLs that aiohttp includes in error messages
+    headers = {"x-goog-api-key": API_KEY}
+    try:
+        async with aiohttp.ClientSession(connector=connector, headers=headers) as session:
+            paths, tasks, inflight = [], [], {}
+            for path in pdf_files:
+                paths.append(path)
+                tasks.append(asyncio.create_task(start_upload(session, sem, inflight, path)))
+                # Let the new task start its request while the scan continues
+                await asyncio.sleep(0)
+            print(f"📂 Found {len(paths)} PDFs.")
+
+            uploads = [(path, file) for path, file in zip(paths, await asyncio.gather(*tasks)) if file]
+
+            # Wait for the File API to finish processing every upload in one loop
+            print(f"⏳ Waiting for {len({file['name'] for _, file in uploads})} uploads to finish processing...")
+            ready = await wait_ready(session, (file for _, file in uploads))
+    finally:
+        # Save whatever was uploaded, even if the run is interrupted
+        flush_upload_cache()
+    return uploads, ready
+
+# --- RESPONSE SCHEMAS ---
+# Built once at import; every request line references the same dicts.
+# QP Schema (Simplified for compactness in script, but strictly enforcing structure)
+QP_SCHEMA = {
+  "type": "OBJECT",
+  "properties": {
+    "subject": {"type": "STRING"},
+    "year": {"type": "INTEGER"},
+    "session": {"type": "STRING"},
+    "total_marks": {"type": "INTEGER"},
+    "groups": {
+      "type": "ARRAY",
+      "items": {
+        "type": "OBJECT",
+        "properties": {
+          "group_id": {"type": "STRING"},
+          "title": {"type": "STRING"},
+          "questions": {
+            "type": "ARRAY",
+            "items": {
+              "type": "OBJECT",
+              "properties": {
+                "id": {"type": "STRING"},
+                "text": {"type": "STRING"},
+                "marks": {"type": "INTEGER"},
+                "options": {
+                  "type": "ARRAY", 
+                  "items": {"type": "OBJECT", "properties": {"label": {"type": "STRING"}, "text": {"type": "STRING"}}}
                 }
               }
             }
@@ -79,99 +293,117 @@ def create_batch_request(pdf_files):
         }
       }
     }
+  }
+}
 
-    # Memo Schema
-    memo_schema = {
+# Memo Schema
+MEMO_SCHEMA = {
+  "type": "OBJECT",
+  "properties": {
+    "meta": {
       "type": "OBJECT",
       "properties": {
-        "meta": {
-          "type": "OBJECT",
-          "properties": {
-            "subject": {"type": "STRING"}, 
-            "year": {"type": "INTEGER"},
-            "session": {"type": "STRING"},
-            "paper": {"type": "STRING"},
-            "total_marks": {"type": "INTEGER"}
-          }
-        },
-        "sections": {
-          "type": "ARRAY",
-          "items": {
-            "type": "OBJECT",
-            "properties": {
-              "section_id": {"type": "STRING"},
-              "questions": {
-                "type": "ARRAY",
-                "items": {
-                  "type": "OBJECT",
-                  "properties": {
-                    "id": {"type": "STRING"},
-                    "model_answers": {"type": "ARRAY", "items": {"type": "STRING"}},
-                    "answers": {
-                      "type": "ARRAY",
-                      "items": {
-                        "type": "OBJECT",
-                        "properties": {
-                          "sub_id": {"type": "STRING"},
-                          "value": {"type": "STRING"},
-                          "marks": {"type": "INTEGER"}
-                        }
-                      }
-                    },
-                    "marks": {"type": "INTEGER"},
-                    "marker_instruction": {"type": "STRING"}
+        "subject": {"type": "STRING"}, 
+        "year": {"type": "INTEGER"},
+        "session": {"type": "STRING"},
+        "paper": {"type": "STRING"},
+        "total_marks": {"type": "INTEGER"}
+      }
+    },
+    "sections": {
+      "type": "ARRAY",
+      "items": {
+        "type": "OBJECT",
+        "properties": {
+          "section_id": {"type": "STRING"},
+          "questions": {
+            "type": "ARRAY",
+            "items": {
+              "type": "OBJECT",
+              "properties": {
+                "id": {"type": "STRING"},
+                "model_answers": {"type": "ARRAY", "items": {"type": "STRING"}},
+                "answers": {
+                  "type": "ARRAY",
+                  "items": {
+                    "type": "OBJECT",
+                    "properties": {
+                      "sub_id": {"type": "STRING"},
+                      "value": {"type": "STRING"},
+                      "marks": {"type": "INTEGER"}
+                    }
                   }
-                }
+                },
+                "marks": {"type": "INTEGER"},
+                "marker_instruction": {"type": "STRING"}
               }
             }
           }
         }
       }
     }
+  }
+}
+
+# Serialised once; each JSONL line splices these in instead of re-walking the trees
+QP_SCHEMA_JSON = orjson.dumps(QP_SCHEMA)
+MEMO_SCHEMA_JSON = orjson.dumps(MEMO_SCHEMA)
+
+def request_line(filename, prompt, file_uri, schema_json):
+    # Byte-for-byte the same as orjson.dumps() of the request dict below, but
+    # only the per-file strings are serialised here
+    # {"custom_id": filename, "request": {"contents": [{"role": "user", "parts": [
+    #     {"text": prompt}, {"file_data": {"mime_type": "application/pdf", "file_uri": file_uri}}]}],
+    #  "generation_config": {"response_mime_type": "application/json", "response_schema": schema}}}
+    return (
+        b'{"custom_id":' + orjson.dumps(filename)
+        + b',"request":{"contents":[{"role":"user","parts":[{"text":' + orjson.dumps(prompt)
+        + b'},{"file_data":{"mime_type":"application/pdf","file_uri":' + orjson.dumps(file_uri)
+        + b'}}]}],"generation_config":{"response_mime_type":"application/json","response_schema":'
+        + schema_json + b'}}}\n'
+    )
+
+def create_batch_request(pdf_files, out_fp):
+    # Each request is written to out_fp (opened in binary mode) as soon as it is
+    # built, so memory stays flat regardless of batch size. Returns the number
+    # of requests written.
+    written = 0
+
+    # Uploads are I/O bound (network + File API processing), so fan them out
+    uploads, ready = asyncio.run(upload_all(pdf_files))
 
-    for i, pdf_path in enumerate(pdf_files):
-        print(f"--- Preparing {i+1}/{len(pdf_files)}: {os.path.basename(pdf_path)} ---")
-        file_uri = upload_file(pdf_path)
+    for pdf_path, file in uploads:
+        filename = os.path.basename(pdf_path)
+        file_uri = ready.get(file["name"])
         if not file_uri:
+            print(f"⏭️  Skipped {filename}: upload never became ACTIVE")
             continue
             
-        filename = os.path.basename(pdf_path)
-        is_memo = "MEMO" in filename.upper() or "MG" in filename.upper()
-        
+        is_memo = bool(MEMO_RE.search(filename))
+    
         prompt = "Extract the full exam paper structure." if not is_memo else "Extract the marking guidelines."
-        schema = memo_schema if is_memo else qp_schema
-        
-        # Construct the request for JSONL
+        schema_json = MEMO_SCHEMA_JSON if is_memo else QP_SCHEMA_JSON
+    
         # Note: The 'custom_id' helps us map results back to files
-        request = {
-            "custom_id": filename,
-            "request": {
-                "contents": [
-                    {"role": "user", "parts": [{"text": prompt}, {"file_data": {"mime_type": "application/pdf", "file_uri": file_uri}}]}
-                ],
-                "generation_config": {
-                    "response_mime_type": "application/json",
-                    "response_schema": schema
-                }
-            }
-        }
-        requests.append(request)
+        out_fp.write(request_line(filename, prompt, file_uri, schema_json))
+        written += 1
+        print(f"--- Prepared {written}: {filename} ---")
         
-    return requests
+    return written
 
-def submit_batch(requests):
-    if not requests:
+def submit_batch(jsonl_path, count):
+    if not count:
         print("❌ No valid requests generated.")
         return
 
-    # 1. Create JSONL file
-    jsonl_path = "batch_requests.jsonl"
-    with open(jsonl_path, "w") as f:
-        for req in requests:
-            f.write(json.dumps(req) + "\n")
-    print(f"✅ Created {jsonl_path} with {len(requests)} items.")
+    # 1. JSONL file was already streamed out by create_batch_request
+    print(f"✅ Using {jsonl_path} with {count} items.")
     
     # 2. Upload JSONL to File API (Batch input)
+    # PDF uploads go through REST; the SDK is only needed here
+    import google.generativeai as genai
+    genai.configure(api_key=API_KEY)
+
     print("📤 Uploading batch input file...")
     batch_input_file = genai.upload_file(jsonl_path)
     
@@ -206,19 +438,22 @@ def submit_batch(requests):
     return batch_input_file.name
 
 if __name__ == "__main__":
+    # Peek at the scan so an empty directory exits before any API setup,
+    # while the rest of the directory is still read lazily
+    files = iter_pdfs(PDF_DIR)
+    first = next(files, None)
+    if first is None:
+        print(f"📂 No PDFs found in {PDF_DIR}, nothing to do.")
+        sys.exit(0)
+    files = itertools.chain([first], files)
+
     setup()
-    files = glob.glob(os.path.join(PDF_DIR, "*.pdf"))
-    print(f"📂 Found {len(files)} PDFs.")
-    
-    requests = create_batch_request(files)
     
     # Save the requests to a file for the next step (submission)
     # We split this because submission might require a specific library version.
-    # We will upload the JSONL manually via curl in the docker container if needed.
+    # This is the only place the JSONL is written; submit_job.py uploads it as-is.
+    with open(JSONL_PATH, "wb") as f:
+        count = create_batch_request(files, f)
     
-    with open("batch_requests.jsonl", "w") as f:
-        for r in requests:
-            f.write(json.dumps(r) + "\n")
-            
-    print(f"\n✅ generated batch_requests.jsonl with {len(requests)} entries.")
+    print(f"\n✅ generated {JSONL_PATH} with {count} entries.")
     print("Run: 'python submit_job.py' (I will create this next) to finalize.")